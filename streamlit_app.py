@@ -1,133 +1,534 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import joblib
+import io
+import json
 import os
+import queue
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from google import generativeai as genai
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.message import EmailMessage
+from google import genai
+from google.genai import errors, types
 from dotenv import load_dotenv
-from sklearn.preprocessing import LabelEncoder
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from xgboost import XGBClassifier
 
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+
 # Load environment variables
 load_dotenv()
 
+TOP_K = 5
+
+# Health score cut points; scores equal to a threshold fall in the riskier bucket.
+RISK_THRESHOLDS = np.array([0.3, 0.7])
+RISK_LEVELS = ["High Risk", "Medium Risk", "Healthy"]
+
+GEMINI_MODEL = "gemini-pro-latest"
+
+# Retention emails are not read live, so they can optionally go through the
+# Gemini Batch API (discounted, asynchronous) instead of one call per customer.
+USE_GEMINI_BATCH = os.environ.get("GEMINI_BATCH_MODE", "").lower() in ("1", "true", "yes")
+BATCH_RESULT_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+BATCH_DONE_STATES = BATCH_RESULT_STATES | {"JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Inference tier for live generation: "standard", "priority" (lowest latency) or "flex".
+# Validated here so a typo fails at startup instead of on every email.
+GEMINI_TIERS = ("standard", "priority", "flex")
+GEMINI_TIER = os.environ.get("GEMINI_TIER", "standard").lower()
+if GEMINI_TIER not in GEMINI_TIERS:
+    raise ValueError(f"GEMINI_TIER must be one of {', '.join(GEMINI_TIERS)}; got {GEMINI_TIER!r}")
+GENERATE_CONFIG = None if GEMINI_TIER == "standard" else types.GenerateContentConfig(service_tier=GEMINI_TIER)
+
+# Concurrent SMTP connections used to send a batch (Gmail allows ~15 per account).
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "3"))
+
+# Transient Gemini/SMTP errors are retried with exponential backoff; after this many
+# consecutive failures of one service the remaining customers are deferred.
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+MAX_CONSECUTIVE_FAILURES = 3
+DEFERRED_STATUS = "Deferred (upstream failure)"
+
+# Generated emails are reusable templates: customers with the same complaint and
+# health band share one Gemini call, and their own details fill these placeholders.
+CUSTOMER_ID_PLACEHOLDER = "{{CUSTOMER_ID}}"
+EMAIL_PLACEHOLDER = "{{EMAIL}}"
+
+EMAIL_PROMPT = """
+You are a customer retention specialist at a telecom company.
+A customer is at high risk of churning. Their details are:
+- Customer ID: {customer_id}
+- Email: {email}
+- Complaint: {complaint}
+- Health Score: about {health_band:.1f} (closer to 0 is worse)
+
+Write a personalized and empathetic HTML email to this customer.
+The goal is to acknowledge their issue, show that you are taking it seriously,
+and offer to help resolve it. Keep the tone professional and caring.
+Do not offer any discounts or promotions.
+Sign off as "Telcom Service Team".
+
+The email should be visually appealing and well-formatted.
+Use HTML tags to structure the email with headings, paragraphs, and bold text for emphasis.
+Write the customer ID and email exactly as the placeholders shown above; they are filled in later.
+"""
+
 # ================================
-#  Load model and encoder (Safe Fallback)
+#  Load model
 # ================================
 @st.cache_resource
 def load_assets():
-    model = joblib.load("saves/model.pkl")
-
-    encoder_path = "saves/label_encoder.pkl"
-    if os.path.exists(encoder_path):
-        try:
-            label_encoder = joblib.load(encoder_path)
-        except Exception as e:
-            st.warning(f"Error loading label encoder: {e}. Creating a new one.")
-            label_encoder = LabelEncoder()
-    else:
-        st.info("Label encoder not found. Creating a new one.")
-        label_encoder = LabelEncoder()
+    return joblib.load("saves/model.pkl")
 
-    return model, label_encoder
+model = load_assets()
 
-model, label_encoder = load_assets()
+# The pipeline selects its inputs by name, so only these columns are handed to it.
+feature_cols = getattr(model, "feature_names_in_", None)
 
 # ================================
 #  Predict churn & health score
 # ================================
-def predict_health_scores(df):
+def compute_scores(df):
     if "TotalCharges" in df.columns:
-        df["TotalCharges"] = pd.to_numeric(df["TotalCharges"], errors="coerce").fillna(0)
+        total_charges = df["TotalCharges"]
+        # Arrow already parsed the column as float64; only string columns need coercing.
+        if not pd.api.types.is_numeric_dtype(total_charges):
+            total_charges = pd.to_numeric(total_charges, errors="coerce")
+        df["TotalCharges"] = total_charges.fillna(0)
+
+    if feature_cols is not None:
+        df_features = df.loc[:, feature_cols]
+    else:
+        df_features = df.drop(columns=[c for c in ["customerID", "Churn"] if c in df])
 
-    if "customerID" in df.columns:
-        ids = df["customerID"]
+    churn_prob = model.predict_proba(df_features)[:, 1]
+    return 1 - churn_prob
+
+def risk_levels(health_score):
+    return pd.Categorical.from_codes(
+        np.searchsorted(RISK_THRESHOLDS, health_score),
+        categories=RISK_LEVELS,
+        ordered=True,
+    )
+
+def read_customer_csv(file_bytes):
+    # Arrow's reader is multithreaded; blank TotalCharges cells become nulls instead of strings.
+    if pa is not None:
+        try:
+            table = pacsv.read_csv(
+                pa.BufferReader(file_bytes),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={"TotalCharges": pa.float64()},
+                    null_values=["", " "],
+                ),
+            )
+            return table.to_pandas()
+        except pa.ArrowInvalid:
+            pass
+    return pd.read_csv(io.BytesIO(file_bytes))
+
+@st.cache_data
+def load_and_score(file_bytes):
+    # Keyed on the uploaded bytes, so widget reruns skip parsing and inference.
+    df = read_customer_csv(file_bytes)
+    return df, compute_scores(df)
+
+def top_risk_customers(df, scores, k=TOP_K):
+    # O(N) selection of the k lowest health scores; only those k rows get sorted.
+    if len(scores) > k:
+        idx = np.argpartition(scores, k)[:k]
     else:
-        ids = pd.Series(range(len(df)))
+        idx = np.arange(len(scores))
+    idx = idx[np.argsort(scores[idx], kind="stable")]
+    return df.iloc[idx].assign(health_score=scores[idx], Risk_Level=risk_levels(scores[idx]))
+
+def build_full_report(df, scores):
+    # Full ranking is only needed for the CSV export.
+    order = np.argsort(scores, kind="stable")
+    report = df.iloc[order].reset_index(drop=True)
+    report["health_score"] = scores[order]
+    report["Rank"] = np.arange(1, len(report) + 1)
+    report["Risk_Level"] = risk_levels(scores[order])
+    return report
+
+@st.cache_data
+def results_to_csv_bytes(file_bytes):
+    # Built lazily from the cached scores, once per upload, only for the export.
+    df, scores = load_and_score(file_bytes)
+    return build_full_report(df, scores).to_csv(index=False).encode("utf-8")
 
-    df_features = df.copy()
-    df_features = df_features.drop(columns=[c for c in ["customerID", "Churn"] if c in df_features])
+# ================================
+#  Retries & Failure Short-Circuit
+# ================================
+class CircuitBreaker:
+    """Trips after ``limit`` consecutive failures of one upstream service.
 
-    churn_prob = model.predict_proba(df_features)[:, 1]
-    df["health_score"] = 1 - churn_prob
-
-    df_sorted = df.sort_values("health_score").reset_index(drop=True)
-    df_sorted["Rank"] = df_sorted.index + 1
-    df_sorted["Risk_Level"] = pd.cut(
-        df_sorted["health_score"],
-        bins=[-0.01, 0.3, 0.7, 1.0],
-        labels=["High Risk", "Medium Risk", "Healthy"]
+    Shared by the pipeline threads; once tripped, remaining work is deferred
+    instead of waiting on more timeouts from a broken endpoint.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.consecutive_failures = 0
+        self.lock = threading.Lock()
+
+    @property
+    def tripped(self):
+        return self.consecutive_failures >= self.limit
+
+    def record(self, ok):
+        with self.lock:
+            self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+
+def retry_with_backoff(func, is_transient, breaker):
+    # The caller records one outcome per row after this returns, so the breaker only
+    # reflects other rows here; once they have tripped it, pending retries give up.
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_transient(e) or breaker.tripped:
+                raise
+            time.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+            if breaker.tripped:
+                raise
+
+def is_transient_gemini_error(e):
+    return isinstance(e, errors.APIError) and (e.code == 429 or e.code >= 500)
+
+def is_transient_smtp_error(e):
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, smtplib.SMTPServerDisconnected) or (
+        isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
     )
-    return df_sorted
 
 # ================================
 #  Generate Email with AI
 # ================================
-def generate_email(customer_data):
+@st.cache_resource
+def get_gemini_client():
+    return genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+
+def template_key(customer_data):
+    return customer_data["complaint"], round(float(customer_data["health_score"]), 1)
+
+def build_template_prompt(complaint, health_band):
+    return EMAIL_PROMPT.format(
+        customer_id=CUSTOMER_ID_PLACEHOLDER,
+        email=EMAIL_PLACEHOLDER,
+        complaint=complaint,
+        health_band=health_band,
+    )
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def generate_template(_client, complaint, health_band, _breaker):
+    # Raises on failure so that errors are never cached.
+    def attempt():
+        response = _client.models.generate_content(
+            model=GEMINI_MODEL,
+            contents=build_template_prompt(complaint, health_band),
+            config=GENERATE_CONFIG,
+        )
+        if not response.text:
+            raise ValueError("Gemini returned an empty email")
+        return response.text
+
+    return retry_with_backoff(attempt, is_transient_gemini_error, _breaker)
+
+def personalize(template, customer_data):
+    return (
+        template
+        .replace(CUSTOMER_ID_PLACEHOLDER, str(customer_data["customerID"]))
+        .replace(EMAIL_PLACEHOLDER, str(customer_data["email"]))
+    )
+
+# ================================
+#  Generate Emails with the Batch API
+# ================================
+def submit_email_batch(keys):
+    lines = [
+        json.dumps({
+            "key": str(n),
+            "request": {"contents": [{"role": "user", "parts": [{"text": build_template_prompt(*key)}]}]},
+        })
+        for n, key in enumerate(keys)
+    ]
+
     try:
-        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-        model = genai.GenerativeModel('gemini-pro-latest')
+        client = get_gemini_client()
+        batch_file = client.files.upload(
+            file=io.BytesIO("\n".join(lines).encode("utf-8")),
+            config=types.UploadFileConfig(display_name="retention-emails", mime_type="jsonl"),
+        )
+        batch_job = client.batches.create(
+            model=GEMINI_MODEL,
+            src=batch_file.name,
+            config={"display_name": "retention-emails"},
+        )
+        return batch_job.name
     except Exception as e:
-        st.error(f"Error configuring Generative AI: {e}")
+        st.error(f"Error submitting email batch: {e}")
         return None
 
-    prompt = f"""
-    You are a customer retention specialist at a telecom company.
-    A customer is at high risk of churning. Their details are:
-    - Customer ID: {customer_data['customerID']}
-    - Email: {customer_data['email']}
-    - Complaint: {customer_data['complaint']}
-    - Health Score: {customer_data['health_score']:.3f} (closer to 0 is worse)
-
-    Write a personalized and empathetic HTML email to this customer.
-    The goal is to acknowledge their issue, show that you are taking it seriously,
-    and offer to help resolve it. Keep the tone professional and caring.
-    Do not offer any discounts or promotions.
-    Sign off as "Telcom Service Team".
-
-    The email should be visually appealing and well-formatted.
-    Use HTML tags to structure the email with headings, paragraphs, and bold text for emphasis.
-    """
-
+def fetch_batch_templates(job_name):
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        client = get_gemini_client()
+        batch_job = client.batches.get(name=job_name)
+        state = batch_job.state.name
+        if state not in BATCH_RESULT_STATES:
+            return state, {}
+        content = client.files.download(file=batch_job.dest.file_name).decode("utf-8")
     except Exception as e:
-        st.error(f"Error generating email: {e}")
+        st.error(f"Error checking email batch: {e}")
+        return None, {}
+
+    # Unreadable or failed results are left out, so their rows get no template.
+    templates = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            result = json.loads(line)
+            parts = result["response"]["candidates"][0]["content"]["parts"]
+            templates[result["key"]] = "".join(part.get("text", "") for part in parts)
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            continue
+    return state, templates
+
+def collect_batch_emails(rows, file_id):
+    # One batch request per distinct template, in first-seen order.
+    keys = list(dict.fromkeys(template_key(row) for row in rows))
+    batch_key = f"email_batch_{file_id}"
+    if batch_key not in st.session_state:
+        st.session_state[batch_key] = submit_email_batch(keys)
+
+    job_name = st.session_state[batch_key]
+    if job_name is None:
+        return {i: None for i in range(len(rows))}
+
+    state, batch_templates = fetch_batch_templates(job_name)
+    if state not in BATCH_DONE_STATES:
+        st.info(f"AI Agent submitted batch job `{job_name}` ({state or 'status unavailable'}). "
+                "Emails will be sent once it completes.")
+        st.button("Check batch status")
         return None
+    if state == "JOB_STATE_PARTIALLY_SUCCEEDED":
+        st.warning("Some emails in the batch could not be generated.")
+    elif state != "JOB_STATE_SUCCEEDED":
+        st.error(f"Email batch finished with state {state}.")
+
+    key_ids = {key: str(n) for n, key in enumerate(keys)}
+    email_contents = {}
+    for i, row in enumerate(rows):
+        template = batch_templates.get(key_ids[template_key(row)])
+        email_contents[i] = personalize(template, row) if template else None
+    return email_contents
 
 # ================================
 #  Send Email
 # ================================
-def send_email(to_address, subject, body):
-    from_address = os.environ.get("SMTP_FROM_EMAIL")
-    smtp_server = os.environ.get("SMTP_SERVER")
-    smtp_port = os.environ.get("SMTP_PORT")
-    smtp_user = os.environ.get("SMTP_USER")
-    smtp_password = os.environ.get("SMTP_PASSWORD")
+class SMTPSession:
+    """One authenticated SMTP connection reused across many sends.
 
-    if not all([from_address, smtp_server, smtp_port, smtp_user, smtp_password]):
-        st.error("SMTP environment variables not set. Please configure them to send emails.")
-        return False
+    The connection is opened lazily on first use, health-checked with NOOP
+    before each reuse and re-established if the server dropped it.
+    """
 
-    msg = MIMEMultipart()
+    def __init__(self):
+        self.from_address = os.environ.get("SMTP_FROM_EMAIL")
+        self.smtp_server = os.environ.get("SMTP_SERVER")
+        self.smtp_port = os.environ.get("SMTP_PORT")
+        self.smtp_user = os.environ.get("SMTP_USER")
+        self.smtp_password = os.environ.get("SMTP_PASSWORD")
+        self.server = None
+
+    @property
+    def configured(self):
+        return all([self.from_address, self.smtp_server, self.smtp_port, self.smtp_user, self.smtp_password])
+
+    def connection(self):
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] == 250:
+                    return self.server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close()
+
+        server = smtplib.SMTP(self.smtp_server, int(self.smtp_port))
+        try:
+            server.starttls()
+            server.login(self.smtp_user, self.smtp_password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        return server
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def build_msg(from_address, to_address, subject, html_body):
+    # Flatten once to wire bytes; sendmail then skips send_message's header re-parsing.
+    # Quoted-printable keeps non-ASCII bodies 7-bit safe for servers without 8BITMIME.
+    msg = EmailMessage()
     msg['From'] = from_address
     msg['To'] = to_address
-    msg['Subject'] = f"Regarding your experience with our service (Customer ID: {to_address})"
-    msg.attach(MIMEText(body, 'html'))
+    msg['Subject'] = subject
+    msg.set_content(html_body, subtype='html', cte='quoted-printable')
+    return msg.as_bytes()
+
+def send_email(smtp_session, to_address, subject, body, breaker):
+    msg_bytes = build_msg(
+        smtp_session.from_address,
+        to_address,
+        f"Regarding your experience with our service (Customer ID: {to_address})",
+        body,
+    )
 
     try:
-        with smtplib.SMTP(smtp_server, int(smtp_port)) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
+        retry_with_backoff(
+            lambda: smtp_session.connection().sendmail(smtp_session.from_address, [to_address], msg_bytes),
+            is_transient_smtp_error,
+            breaker,
+        )
         return True
     except Exception as e:
         st.error(f"Error sending email: {e}")
+        smtp_session.close()
         return False
 
+# ================================
+#  Generate & Send Pipeline
+# ================================
+_PIPELINE_DONE = object()
+_DEFERRED = object()
+
+def generate_task(client, key, breaker):
+    if breaker.tripped:
+        return _DEFERRED
+    try:
+        template = generate_template(client, *key, breaker)
+    except Exception as e:
+        st.error(f"Error generating email: {e}")
+        template = None
+    breaker.record(template is not None)
+    return template
+
+def send_worker(email_queue, statuses, breaker):
+    # Each sender owns one pooled SMTP connection and drains bodies as soon as they are ready.
+    with SMTPSession() as smtp_session:
+        while True:
+            item = email_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+
+            i, row, email_content = item
+            if email_content is _DEFERRED or (email_content and breaker.tripped):
+                statuses[i] = DEFERRED_STATUS
+            elif not email_content:
+                statuses[i] = "Generation Failed"
+            else:
+                sent = send_email(smtp_session, row["email"], "Regarding your experience with our service",
+                                  email_content, breaker)
+                breaker.record(sent)
+                statuses[i] = "Sent" if sent else "Failed to Send"
+
+def run_email_pipeline(rows, email_contents=None):
+    """Generate and send an email for every row, overlapping Gemini and SMTP work.
+
+    Bodies come from a thread pool calling Gemini once per distinct
+    (complaint, health band) template, or from ``email_contents``
+    when they were already generated (e.g. by a batch job), and are sent as they
+    arrive by up to ``SMTP_POOL_SIZE`` threads, each holding its own SMTP
+    connection. Once either service fails ``MAX_CONSECUTIVE_FAILURES`` times
+    in a row (or a third of a larger batch), the remaining rows are deferred.
+    Returns the delivery status of each row.
+    """
+    # A local configuration error is reported once, not as an upstream outage per row.
+    if not SMTPSession().configured:
+        st.error("SMTP environment variables not set. Please configure them to send emails.")
+        return ["Failed to Send"] * len(rows)
+
+    email_queue = queue.Queue()
+    statuses = {}
+    failure_limit = max(MAX_CONSECUTIVE_FAILURES, len(rows) // 3)
+    generate_breaker = CircuitBreaker(failure_limit)
+    send_breaker = CircuitBreaker(failure_limit)
+
+    # Worker threads inherit the script context so st.error still renders.
+    ctx = get_script_run_ctx()
+    senders = [
+        add_script_run_ctx(threading.Thread(target=send_worker, args=(email_queue, statuses, send_breaker)), ctx)
+        for _ in range(max(1, min(SMTP_POOL_SIZE, len(rows))))
+    ]
+    for sender in senders:
+        sender.start()
+
+    try:
+        if email_contents is not None:
+            for i, row in enumerate(rows):
+                email_queue.put((i, row, email_contents[i]))
+        else:
+            # Resolve the shared client once here rather than in every worker,
+            # so a configuration error is reported once instead of per customer.
+            try:
+                client = get_gemini_client()
+            except Exception as e:
+                st.error(f"Error configuring Generative AI: {e}")
+                client = None
+
+            if client is None:
+                for i, row in enumerate(rows):
+                    email_queue.put((i, row, None))
+            else:
+                rows_by_key = {}
+                for i, row in enumerate(rows):
+                    rows_by_key.setdefault(template_key(row), []).append(i)
+
+                with ThreadPoolExecutor(
+                    max_workers=len(rows_by_key) or 1,
+                    initializer=add_script_run_ctx,
+                    initargs=(None, ctx),
+                ) as executor:
+                    futures = {
+                        executor.submit(generate_task, client, key, generate_breaker): key
+                        for key in rows_by_key
+                    }
+                    for future in as_completed(futures):
+                        template = future.result()
+                        for i in rows_by_key[futures[future]]:
+                            email_content = personalize(template, rows[i]) if isinstance(template, str) else template
+                            email_queue.put((i, rows[i], email_content))
+    finally:
+        for _ in senders:
+            email_queue.put(_PIPELINE_DONE)
+        for sender in senders:
+            sender.join()
+
+    return [statuses.get(i, "Failed to Send") for i in range(len(rows))]
+
 # ================================
 #  Streamlit UI
 # ================================
@@ -139,13 +540,13 @@ st.caption("Predict churn risk and trigger retention automation through n8n")
 uploaded_file = st.file_uploader("Upload your customer CSV", type=["csv"])
 
 if uploaded_file:
-    df = pd.read_csv(uploaded_file)
     st.success(f"File uploaded: {uploaded_file.name}")
+    file_bytes = uploaded_file.getvalue()
 
     with st.spinner("Analyzing customer data..."):
-        results = predict_health_scores(df)
+        df, scores = load_and_score(file_bytes)
 
-    top_5 = results.sort_values("health_score").head(5)
+    top_5 = top_risk_customers(df, scores)
     st.subheader("Top 5 High-Risk Customers")
     st.dataframe(
         top_5[["customerID", "email", "complaint", "health_score", "Risk_Level"]]
@@ -162,56 +563,46 @@ if uploaded_file:
         current_file_id = f"{uploaded_file.name}_{len(top_5)}"
 
         if f"emails_sent_{current_file_id}" not in st.session_state:
-            st.info("AI Agent is automatically generating and sending emails to top 5 at-risk customers...")
-
-            success_count = 0
-            failed_count = 0
-            email_reports = []
-
-            with st.spinner("AI Agent: Generating personalized emails and sending..."):
-                for _, row in top_5.iterrows():
-                    customer_id = row["customerID"]
-                    customer_email = row["email"]
-
-                    email_content = generate_email(row)
-                    if email_content:
-                        subject = "Regarding your experience with our service"
-                        if send_email(customer_email, subject, email_content):
-                            success_count += 1
-                            email_reports.append({
-                                "customerID": customer_id,
-                                "email": customer_email,
-                                "status": "Sent",
-                                "health_score": row["health_score"]
-                            })
-                        else:
-                            failed_count += 1
-                            email_reports.append({
-                                "customerID": customer_id,
-                                "email": customer_email,
-                                "status": "Failed to Send",
-                                "health_score": row["health_score"]
-                            })
-                    else:
-                        failed_count += 1
-                        email_reports.append({
-                            "customerID": customer_id,
-                            "email": customer_email,
-                            "status": "Generation Failed",
-                            "health_score": row["health_score"]
-                        })
-
-            st.session_state[f"emails_sent_{current_file_id}"] = True
-            st.session_state[f"email_reports_{current_file_id}"] = email_reports
-
-            if success_count > 0:
-                st.success(f"AI Agent successfully sent {success_count} personalized retention emails.")
-            if failed_count > 0:
-                st.warning(f"{failed_count} emails failed to send.")
-
-            st.markdown("#### Email Delivery Report")
-            report_df = pd.DataFrame(email_reports)
-            st.dataframe(report_df, use_container_width=True, hide_index=True)
+            rows = top_5[["customerID", "email", "complaint", "health_score"]].to_dict("records")
+
+            if USE_GEMINI_BATCH:
+                email_contents = collect_batch_emails(rows, current_file_id)
+                pipeline_ready = email_contents is not None
+            else:
+                st.info("AI Agent is automatically generating and sending emails to top 5 at-risk customers...")
+                email_contents = None
+                pipeline_ready = True
+
+            if pipeline_ready:
+                with st.spinner("AI Agent: Generating personalized emails and sending..."):
+                    statuses = run_email_pipeline(rows, email_contents)
+
+                email_reports = [
+                    {
+                        "customerID": row["customerID"],
+                        "email": row["email"],
+                        "status": status,
+                        "health_score": row["health_score"]
+                    }
+                    for row, status in zip(rows, statuses)
+                ]
+                success_count = statuses.count("Sent")
+                deferred_count = statuses.count(DEFERRED_STATUS)
+                failed_count = len(statuses) - success_count - deferred_count
+
+                st.session_state[f"emails_sent_{current_file_id}"] = True
+                st.session_state[f"email_reports_{current_file_id}"] = email_reports
+
+                if success_count > 0:
+                    st.success(f"AI Agent successfully sent {success_count} personalized retention emails.")
+                if failed_count > 0:
+                    st.warning(f"{failed_count} emails failed to send.")
+                if deferred_count > 0:
+                    st.warning(f"{deferred_count} emails were deferred after repeated upstream failures.")
+
+                st.markdown("#### Email Delivery Report")
+                report_df = pd.DataFrame(email_reports)
+                st.dataframe(report_df, use_container_width=True, hide_index=True)
 
         else:
             st.success("AI Agent has already sent emails for these customers.")
@@ -219,10 +610,10 @@ if uploaded_file:
             report_df = pd.DataFrame(st.session_state[f"email_reports_{current_file_id}"])
             st.dataframe(report_df, use_container_width=True, hide_index=True)
 
-    csv = results.to_csv(index=False).encode("utf-8")
     st.download_button(
         label="Download Full Predictions CSV",
-        data=csv,
+        # Built only when the user actually clicks download
+        data=lambda: results_to_csv_bytes(file_bytes),
         file_name="health_scores.csv",
         mime="text/csv"
     )
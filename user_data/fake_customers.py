@@ -1,8 +1,14 @@
-import pandas as pd
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
 
-np.random.seed(41)
-n = 20  # number of fake users
+# Written next to this script; a .parquet path skips CSV formatting entirely
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_customers.csv")
 
 # Example complaint categories
 complaints = [
@@ -18,39 +24,181 @@ complaints = [
     "Received incorrect bill amount"
 ]
 
-# Generate dataset
-test_data = pd.DataFrame({
-    "customerID": [f"{i:04d}-TEST" for i in range(1, n + 1)],
-    "gender": np.random.choice(["Male", "Female"], n),
-    "SeniorCitizen": np.random.choice([0, 1], n),
-    "Partner": np.random.choice(["Yes", "No"], n),
-    "Dependents": np.random.choice(["Yes", "No"], n),
-    "tenure": np.random.randint(1, 72, n),
-    "PhoneService": np.random.choice(["Yes", "No"], n),
-    "MultipleLines": np.random.choice(["Yes", "No", "No phone service"], n),
-    "InternetService": np.random.choice(["DSL", "Fiber optic", "No"], n),
-    "OnlineSecurity": np.random.choice(["Yes", "No", "No internet service"], n),
-    "OnlineBackup": np.random.choice(["Yes", "No", "No internet service"], n),
-    "DeviceProtection": np.random.choice(["Yes", "No", "No internet service"], n),
-    "TechSupport": np.random.choice(["Yes", "No", "No internet service"], n),
-    "StreamingTV": np.random.choice(["Yes", "No", "No internet service"], n),
-    "StreamingMovies": np.random.choice(["Yes", "No", "No internet service"], n),
-    "Contract": np.random.choice(["Month-to-month", "One year", "Two year"], n),
-    "PaperlessBilling": np.random.choice(["Yes", "No"], n),
-    "PaymentMethod": np.random.choice(
-        ["Electronic check", "Mailed check", "Bank transfer (automatic)", "Credit card (automatic)"],
-        n
-    ),
-    "MonthlyCharges": np.random.uniform(20, 120, n),
-    "TotalCharges": np.random.uniform(100, 8000, n),
-})
-
-# Add email and complaint columns
-test_data["email"] = test_data["customerID"].apply(
-    lambda x: f"{x.lower().replace('-test', '')}@telecommail.com"
-)
-test_data["complaint"] = np.random.choice(complaints, n)
-
-# Save CSV
-test_data.to_csv("test_customers.csv", index=False)
-print("✅ Generated test_customers.csv with emails and complaints successfully!")
+# Possible values for each categorical column
+categories = {
+    "gender": ["Male", "Female"],
+    "SeniorCitizen": [0, 1],
+    "Partner": ["Yes", "No"],
+    "Dependents": ["Yes", "No"],
+    "PhoneService": ["Yes", "No"],
+    "MultipleLines": ["Yes", "No", "No phone service"],
+    "InternetService": ["DSL", "Fiber optic", "No"],
+    "OnlineSecurity": ["Yes", "No", "No internet service"],
+    "OnlineBackup": ["Yes", "No", "No internet service"],
+    "DeviceProtection": ["Yes", "No", "No internet service"],
+    "TechSupport": ["Yes", "No", "No internet service"],
+    "StreamingTV": ["Yes", "No", "No internet service"],
+    "StreamingMovies": ["Yes", "No", "No internet service"],
+    "Contract": ["Month-to-month", "One year", "Two year"],
+    "PaperlessBilling": ["Yes", "No"],
+    "PaymentMethod": ["Electronic check", "Mailed check", "Bank transfer (automatic)", "Credit card (automatic)"],
+}
+
+# Dictionaries are built once and shared by every chunk
+category_dictionaries = {col: pa.array(values) for col, values in categories.items()}
+complaint_dictionary = pa.array(complaints)
+
+# The last value of these columns ("No phone service" / "No internet service") is implied
+# by the parent column being "No"; otherwise they are a plain Yes/No draw
+dependent_columns = {
+    "MultipleLines": "PhoneService",
+    "OnlineSecurity": "InternetService",
+    "OnlineBackup": "InternetService",
+    "DeviceProtection": "InternetService",
+    "TechSupport": "InternetService",
+    "StreamingTV": "InternetService",
+    "StreamingMovies": "InternetService",
+}
+
+# Two-way draws are packed as the bits of one random uint16 per row; the rest share one code draw
+bit_columns = [col for col, values in categories.items() if len(values) == 2 or col in dependent_columns]
+multi_columns = [col for col in categories if col not in bit_columns]
+multi_sizes = [len(categories[col]) for col in multi_columns]
+assert len(bit_columns) <= 16
+
+CHUNK_SIZE = 100_000  # rows generated and written at a time
+
+# Bump whenever the generated columns or their distributions change, so existing
+# outputs are regenerated instead of being reused as up to date.
+SCHEMA_VERSION = 2
+
+# Below this many rows the draws are too small for threads to pay off
+PARALLEL_MIN_ROWS = 100_000
+
+
+def open_writer(path, schema):
+    """Streaming writer for ``path``: zstd Parquet for ``.parquet``, CSV otherwise."""
+    if path.endswith(".parquet"):
+        return pq.ParquetWriter(path, schema, compression="zstd")
+    return pacsv.CSVWriter(path, schema)
+
+
+def draw_columns(rng, k, executor=None):
+    """Independent random draws for one chunk, each from its own spawned stream.
+
+    Streams are spawned in a fixed order, so results are identical whether the
+    draws run serially or on ``executor`` (numpy releases the GIL while drawing).
+    """
+    tasks = {
+        # One call for all two-way draws (bit j -> column j) and one for the multi-way codes
+        "bits": lambda g: g.integers(0, 1 << 16, k, dtype=np.uint16),
+        "codes": lambda g: g.integers(0, multi_sizes, size=(k, len(multi_sizes)), dtype=np.int8),
+        "tenure": lambda g: g.integers(1, 72, k),
+        # Charges are rounded to cents in bulk so the writer emits short decimals, not 17-digit reprs
+        "MonthlyCharges": lambda g: g.uniform(20, 120, k).round(2),
+        "TotalCharges": lambda g: g.uniform(100, 8000, k).round(2),
+        "complaint": lambda g: g.integers(0, len(complaints), k, dtype=np.int8),
+    }
+    streams = rng.spawn(len(tasks))
+    run = map if executor is None else executor.map
+    return dict(zip(tasks, run(lambda task, stream: task(stream), tasks.values(), streams)))
+
+
+def generate_chunk(rng, start, k, executor=None):
+    """Generate customers ``start + 1`` .. ``start + k`` as an Arrow table."""
+    draws = draw_columns(rng, k, executor)
+
+    cat_codes = {col: ((draws["bits"] >> j) & 1).astype(np.int8) for j, col in enumerate(bit_columns)}
+    cat_codes.update({col: draws["codes"][:, j] for j, col in enumerate(multi_columns)})
+    for col, parent in dependent_columns.items():
+        parent_no = cat_codes[parent] == categories[parent].index("No")
+        cat_codes[col] = np.where(parent_no, len(categories[col]) - 1, cat_codes[col]).astype(np.int8)
+
+    # Zero-padded customer numbers shared by the ID and email columns
+    # (zfill cannot size an empty array, so a zero-row chunk is left as is)
+    ids = np.arange(start + 1, start + k + 1).astype(str)
+    if k:
+        ids = np.char.zfill(ids, 4)
+
+    arrays = {
+        "customerID": np.char.add(ids, "-TEST"),
+        # Columns are built straight from the codes, so no k-length string arrays are materialized
+        **{
+            col: pa.DictionaryArray.from_arrays(cat_codes[col], dictionary)
+            for col, dictionary in category_dictionaries.items()
+        },
+    }
+    arrays["MonthlyCharges"] = draws["MonthlyCharges"]
+    arrays["TotalCharges"] = draws["TotalCharges"]
+
+    # Add email and complaint columns
+    arrays["email"] = np.char.add(ids, "@telecommail.com")
+    arrays["complaint"] = pa.DictionaryArray.from_arrays(draws["complaint"], complaint_dictionary)
+
+    # One pass into Arrow; numeric columns are zero-copy
+    table = pa.table(arrays)
+    return table.add_column(table.schema.get_field_index("PhoneService"), "tenure", pa.array(draws["tenure"]))
+
+
+def generation_key(n, seed):
+    """Fingerprint of every input that determines the generated rows."""
+    inputs = (n, seed, complaints, categories, dependent_columns, CHUNK_SIZE, SCHEMA_VERSION)
+    return hashlib.blake2b(repr(inputs).encode()).hexdigest()
+
+
+def generate_chunks(rng, n, executor=None):
+    """Yield ``n`` customers as consecutive Arrow tables of up to ``CHUNK_SIZE`` rows."""
+    # n == 0 still yields one empty chunk, so the schema (and a header) is always produced
+    for start in range(0, max(n, 1), CHUNK_SIZE):
+        yield generate_chunk(rng, start, min(CHUNK_SIZE, n - start), executor)
+
+
+def generate(n, seed=41, out=DEFAULT_OUTPUT):
+    """Generate ``n`` fake customers.
+
+    With ``out=None`` the customers are returned as an in-memory Arrow table,
+    built from the same chunks (and so the same rows) as the file output.
+    Otherwise they are streamed to ``out`` one chunk at a time, so peak memory
+    stays O(CHUNK_SIZE) for any ``n``. The output is a pure function of its
+    inputs, so a ``<out>.meta`` sidecar records them and an up-to-date file is
+    left untouched. Returns whether ``out`` was (re)written.
+    """
+    if out is not None:
+        key = generation_key(n, seed)
+        meta_path = out + ".meta"
+        if os.path.exists(out) and os.path.exists(meta_path):
+            with open(meta_path) as meta:
+                if meta.read().strip() == key:
+                    return False
+
+        # Drop the old sidecar first so an interrupted write is never mistaken for up to date
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+    rng = np.random.default_rng(seed)
+    executor = ThreadPoolExecutor() if n >= PARALLEL_MIN_ROWS else None
+    writer = None
+    try:
+        if out is None:
+            return pa.concat_tables(generate_chunks(rng, n, executor))
+        for table in generate_chunks(rng, n, executor):
+            if writer is None:
+                writer = open_writer(out, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+        if executor is not None:
+            executor.shutdown()
+
+    with open(meta_path, "w") as meta:
+        meta.write(key)
+    return True
+
+
+if __name__ == "__main__":
+    n = 20  # number of fake users
+    if generate(n):
+        print(f"✅ Generated {os.path.basename(DEFAULT_OUTPUT)} with emails and complaints successfully!")
+    else:
+        print(f"✅ {os.path.basename(DEFAULT_OUTPUT)} is already up to date.")